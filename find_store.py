@@ -24,21 +24,50 @@ Example
 import csv
 import json
 import sys
+import weakref
 from decimal import Decimal
-from math import asin, cos, pow, radians, sin, sqrt
+from functools import lru_cache
+from math import asin, cos, radians, sin, sqrt
 from docopt import docopt
 import googlemaps
+import numpy as np
+from scipy.spatial import cKDTree
+
+try:
+    import orjson
+except ImportError:  # pragma no cover
+    orjson = None
+
+
+def _dumps(js):
+    """
+    Pretty-print js as (ASCII-escaped) JSON, using orjson if it is installed.
+    Keys are written in insertion order; callers build their dicts already sorted.
+    """
+    if orjson is not None:
+        # orjson can't escape non-ASCII, so only use its output when there is none
+        try:
+            return orjson.dumps(js, option=orjson.OPT_INDENT_2).decode('ascii')
+        except UnicodeDecodeError:
+            pass
+    return json.dumps(js, indent=2)
 
 
 def _quantize(d):
     """Convenience helper for rendering distance/lat/long"""
-    return str(d.quantize(Decimal('0.001')))
+    # go through str() so that floats round the way their printed value would (e.g. -89.7555 -> -89.756)
+    return str(Decimal(str(d)).quantize(Decimal('0.001')))
 
 
 class Store(object):
     """
     Encapsulate a Store so that we can easily pre-process radian coordinates, and have helpful rendering methods.
     """
+    __slots__ = (
+        'name', 'location', 'address', 'city', 'state', 'zip', 'lat', 'long', 'county',
+        'lat_radians', 'long_radians', '_radian_coords', 'cos_lat',
+    )
+
     def __init__(self, name, lat, long, location='', address='', city='', state='', zip='', county=''):
         self.name = name
         self.location = location
@@ -46,87 +75,169 @@ class Store(object):
         self.city = city
         self.state = state
         self.zip = zip
-        self.lat = Decimal(lat)
-        self.long = Decimal(long)
+        self.lat = float(lat)
+        self.long = float(long)
         # pre-compute these so that we can make it faster to calculate distances
         # from all the stores. ;)
         self.lat_radians = radians(self.lat)
         self.long_radians = radians(self.long)
+        self._radian_coords = (self.lat_radians, self.long_radians)
+        # cos(latitude) is the same for every query, so great_circle_distance can reuse it
+        self.cos_lat = cos(self.lat_radians)
         self.county = county
 
     def get_radian_coords(self):
-        return (self.lat_radians, self.long_radians)
+        return self._radian_coords
+
+    def get_rendered_coords(self):
+        """(latitude, longitude) as displayed by to_js and __str__"""
+        return (_quantize(self.lat), _quantize(self.long))
 
     def to_js(self):
+        (lat, long) = self.get_rendered_coords()
+        # keys in sorted order, so that render doesn't have to sort them
         return {
-            'name': self.name,
-            'location': self.location,
             'address': self.address,
             'city': self.city,
+            'county': self.county,
+            'latitude': lat,
+            'location': self.location,
+            'longitude': long,
+            'name': self.name,
             'state': self.state,
             'zip': self.zip,
-            'county': self.county,
-            'latitude': _quantize(self.lat),
-            'longitude': _quantize(self.long),
         }
 
     @classmethod
     def from_line(cls, line):
-        return cls(
-            name=line[0],  # e.g 'Plano West',
-            location=line[1],  # e.g 'NEC Dallas N Tollway & W Park Blvd',
-            address=line[2],  # e.g '2200 Dallas Pkwy',
-            city=line[3],  # e.g 'Plano',
-            state=line[4],  # e.g 'TX',
-            zip=line[5],  # e.g '75093-4300',
-            lat=line[6],  # e.g '33.0304051',
-            long=line[7],  # e.g '-96.8270449',
-            county=line[8],  # e.g 'Collin County',
-        )
+        (
+            name,  # e.g 'Plano West',
+            location,  # e.g 'NEC Dallas N Tollway & W Park Blvd',
+            address,  # e.g '2200 Dallas Pkwy',
+            city,  # e.g 'Plano',
+            state,  # e.g 'TX',
+            zip,  # e.g '75093-4300',
+            lat,  # e.g '33.0304051',
+            long,  # e.g '-96.8270449',
+            county,  # e.g 'Collin County',
+        ) = line[:9]  # ignore any extra columns
+        # positional, in __init__'s order, to skip building a kwargs dict per row
+        return cls(name, lat, long, location, address, city, state, zip, county)
 
     def __repr__(self):
         return f'<Store {self.name} {self.lat} {self.long}>'
 
     def __str__(self):
+        (lat, long) = self.get_rendered_coords()
         return (
             f'Store: {self.name}\n'
             f'    {self.location} ({self.county})\n'
             f'    {self.address}\n'
             f'    {self.city}\n'
             f'    {self.state}, {self.zip}\n'
-            f'    Latitude:  {_quantize(self.lat)}\n'
-            f'    Longitude: {_quantize(self.long)}\n'
+            f'    Latitude:  {lat}\n'
+            f'    Longitude: {long}\n'
         )
 
 
+def _to_unit_vectors(lats, longs):
+    """Project arrays of (latitude, longitude) radians to (x, y, z) points on the unit sphere"""
+    cos_lats = np.cos(lats)
+    return np.stack([cos_lats * np.cos(longs), cos_lats * np.sin(longs), np.sin(lats)], axis=1)
+
+
+class StoreLocations(object):
+    """
+    A read-only sequence of Stores, laid out for fast distance calculations.
+
+    The Store objects are only needed for rendering, so their radian coordinates
+    are also packed into contiguous arrays, and projected onto the unit sphere to
+    build a KD-tree that find_store can query directly.
+
+    Stores at the same location share one point in the tree, which maps back to
+    the first of them (tree_index), since cKDTree doesn't pick the first of tied
+    points itself.
+    """
+    def __init__(self, stores):
+        self.stores = tuple(stores)
+        count = len(self.stores)
+        self.lat_radians = np.fromiter((s.lat_radians for s in self.stores), dtype=np.float64, count=count)
+        self.long_radians = np.fromiter((s.long_radians for s in self.stores), dtype=np.float64, count=count)
+        (points, self.tree_index) = np.unique(
+            _to_unit_vectors(self.lat_radians, self.long_radians), axis=0, return_index=True)
+        self.tree = cKDTree(points)
+
+    def __len__(self):
+        return len(self.stores)
+
+    def __getitem__(self, i):
+        return self.stores[i]
+
+    def __iter__(self):
+        return iter(self.stores)
+
+    def __repr__(self):
+        return f'<StoreLocations ({len(self)} stores)>'
+
+
+@lru_cache(maxsize=None)
 def get_store_locations(fname='store-locations.csv'):
     """
-    Parse the store locations, names, etc from the CSV
-    For now, we'll just put these in dicts.  At some point, it may be good to put them in Store objects.
+    Parse the store locations, names, etc from the CSV into a StoreLocations
+
+    The result is cached per fname so that repeated lookups in the same process
+    only parse the CSV (and build the KD-tree) once; use
+    get_store_locations.cache_clear() to pick up changes to the file.
     """
-    stores = []
     with open(fname) as f:
-        # using reader(f.readlines()) so that our mock will work with csv.reader
-        reader = csv.reader(f.readlines())
-        stores = [Store.from_line(line) for i, line in enumerate(reader) if i != 0]
+        reader = csv.reader(f)
+        next(reader, None)  # skip the header
+        stores = [Store.from_line(line) for line in reader]
 
-    return stores
+    return StoreLocations(stores)
 
 
+@lru_cache(maxsize=None)
 def get_api_keys(fname='api-keys.json'):
-    """Read API keys from a gitignored configuration file"""
+    """Read API keys from a gitignored configuration file (once per fname)"""
     with open(fname) as f:
         return json.load(f)
 
 
-EARTH_RADIUS_KM = Decimal('6378.137')
-EARTH_RADIUS_MI = Decimal('3963.191')
+@lru_cache(maxsize=None)
+def _client():
+    """
+    Shared googlemaps.Client, so that repeated lookups in the same process reuse
+    its HTTP session (and keep-alive connection) rather than opening a new one.
+    """
+    api_keys = get_api_keys()
+    return googlemaps.Client(key=api_keys['GOOGLE_GEOCODING_API_KEY'])
+
+
+@lru_cache(maxsize=8192)
+def _geocode(query):
+    """
+    Geocode an address or zip, remembering the result so that repeated queries
+    (e.g. many lookups for the same zip) don't each make an HTTP round-trip.
+    """
+    return _client().geocode(query)
+
+
+EARTH_RADIUS_KM = 6378.137
+EARTH_RADIUS_MI = 3963.191
 
 
-def great_circle_distance(a, b, km=True):
+def great_circle_distance(a, b, km=True, cos_lat_b=None, radius=None,
+                          _sin=sin, _cos=cos, _sqrt=sqrt, _asin=asin):
     """
     Return the distance (along a great circle of a sphere)
 
+    If it is already known (e.g. Store.cos_lat), pass cos(lat_b) as cos_lat_b
+    to save recomputing it. Callers measuring many distances can likewise pick
+    EARTH_RADIUS_KM/EARTH_RADIUS_MI once and pass it as radius, which takes
+    precedence over km. (The underscored arguments just bind the math
+    functions as locals, which are cheaper to look up than globals.)
+
     We use the simpler haversine formula, as we aren't really concerned
     with the rounding errors that might occur for stores that are on opposite
     sides of the globe from each other.
@@ -140,39 +251,75 @@ def great_circle_distance(a, b, km=True):
 
     delta_lat = abs(lat_a - lat_b)
     delta_lon = abs(lon_a - lon_b)
+    if cos_lat_b is None:
+        cos_lat_b = _cos(lat_b)
 
-    delta = 2 * asin(sqrt(
-        pow(sin(delta_lat/2), 2)
+    sin_lat = _sin(delta_lat * 0.5)
+    sin_lon = _sin(delta_lon * 0.5)
+    delta = 2 * _asin(_sqrt(
+        sin_lat * sin_lat
         +
-        (cos(lat_a) * cos(lat_b) * pow(sin(delta_lon/2), 2))
+        (_cos(lat_a) * cos_lat_b * sin_lon * sin_lon)
     ))
 
-    r = EARTH_RADIUS_KM if km else EARTH_RADIUS_MI
-    return r * Decimal(delta)
+    if radius is None:
+        radius = EARTH_RADIUS_KM if km else EARTH_RADIUS_MI
+    return radius * delta
 
 
 def find_store(start, stores, units='mi'):
     """
     Find the closest store among stores
+
+    The straight-line (chord) distance between two points on a sphere grows with
+    the great circle distance between them, so the nearest store in the KD-tree
+    is also the nearest one along the surface. If several stores are equally
+    close (whether at the same location or not), return the first of them.
+
+    stores may be any sequence of Stores, but passing a StoreLocations (as
+    returned by get_store_locations) avoids rebuilding the KD-tree per call.
     """
-    use_km = (units != 'mi')
-    stores_by_distance = [
-        (store, great_circle_distance(start, store.get_radian_coords(), use_km))
-        for store in stores
-    ]
+    if not isinstance(stores, StoreLocations):
+        stores = StoreLocations(stores)
 
-    # return the (first) closest one, even if a tie
-    return sorted(stores_by_distance, key=lambda item: item[1])[0]
+    (lat, lon) = start  # must be in radians
+    point = _to_unit_vectors(np.array([lat]), np.array([lon]))[0]
+    (chord, idx) = stores.tree.query(point, k=1)
+
+    # the tree returns an arbitrary one of several equally-close points, so gather
+    # every point within (rounding of) that distance and take the first store among them
+    tied = stores.tree.query_ball_point(point, chord * (1 + 1e-12))
+    first = min(stores.tree_index[i] for i in tied) if tied else stores.tree_index[idx]
+
+    # convert the chord back to an arc; min() so rounding can't push asin out of its domain
+    r = EARTH_RADIUS_KM if units != 'mi' else EARTH_RADIUS_MI
+    return (stores[int(first)], r * 2 * asin(min(chord / 2, 1.0)))
+
+
+def _find_store_cached(start, stores, units):
+    """
+    find_store, memoized for repeated queries from the same start point.
+
+    The cache only holds a weak reference to stores, so a reloaded
+    get_store_locations gets fresh results, and the old StoreLocations (and its
+    KD-tree) can still be freed; its stale entries just age out of the cache.
+    """
+    return _find_store_by_ref(start, weakref.ref(stores), units)
+
+
+@lru_cache(maxsize=4096)
+def _find_store_by_ref(start, stores_ref, units):
+    return find_store(start, stores_ref(), units)
 
 
 def render(store, distance, units, output='text'):
     if output == 'json':
         js = {
-            'store': store.to_js(),
             'distance': _quantize(distance),
+            'store': store.to_js(),
             'units': units,
         }
-        print(json.dumps(js, indent=2, sort_keys=True))
+        print(_dumps(js))
     else:
         print(str(store))
         print(f'Distance: {_quantize(distance)} {units}')
@@ -187,10 +334,7 @@ def main(argv):
     units = arguments['--units']  # 'km' or 'mi'
     output = arguments['--output']  # default text
 
-    api_keys = get_api_keys()
-    gmaps = googlemaps.Client(key=api_keys['GOOGLE_GEOCODING_API_KEY'])
-
-    geocoded = gmaps.geocode(address or zip)
+    geocoded = _geocode(address or zip)
     # pre-calculate radians so we don't have to do it in great_circle_distance
     start = (
         radians(geocoded[0]['geometry']['location']['lat']),
@@ -199,7 +343,7 @@ def main(argv):
 
     stores = get_store_locations()
 
-    (store, distance) = find_store(start=start, stores=stores, units=units)
+    (store, distance) = _find_store_cached(start, stores, units)
     render(store, distance, units, output)
 
 
@@ -2,14 +2,22 @@
 Tests for find_store.py
 """
 
+import gc
 import json
+import weakref
 from io import StringIO
+from itertools import permutations
 from unittest import main as unittest_main, TestCase
 from unittest.mock import patch, mock_open
-from decimal import Decimal
-from math import radians
+from math import asin, radians
 from find_store import (
     __doc__ as find_store_doc,
+    _client,
+    _find_store_by_ref,
+    _find_store_cached,
+    _geocode,
+    EARTH_RADIUS_KM,
+    EARTH_RADIUS_MI,
     find_store as _find_store,
     get_api_keys,
     great_circle_distance,
@@ -17,16 +25,27 @@ from find_store import (
     main,
     render,
     Store,
+    StoreLocations,
 )
 
 
+# a small store-locations.csv, for tests that mock reading it
+STORE_CSV = ''.join([
+    'Store Name,Store Location,Address,City,State,Zip Code,Latitude,Longitude,County\n',
+    'Name1,Store Location1,Address1,City1,State1,Zip Code1,1.111,10.111,County1\n',
+    'Name2,Store Location2,Address2,City2,State2,Zip Code2,2.222,20.222,County2\n',
+])
+
+
 class StoreTest(TestCase):
     """
     Verify that we can construct Store records, and render them in various ways
     """
 
-    def setUp(self):
-        self.store = Store(
+    @classmethod
+    def setUpClass(cls):
+        # none of these tests modify the store, so share one
+        cls.store = Store(
             name='Name',
             location='Human readable location',
             address='123 Street Address',
@@ -47,14 +66,14 @@ class StoreTest(TestCase):
             'city': 'City',
             'state': 'STATE',
             'zip': '12345-1234',
-            'lat': Decimal('33.1234'),
-            'long': Decimal('-96.1234'),
+            'lat': 33.1234,
+            'long': -96.1234,
             'lat_radians': 0.5781123894550897,
             'long_radians': -1.6776698182115175,
+            'cos_lat': 0.8374956148742944,
             'county': 'County',
         }
-        for (k, v) in expected.items():
-            self.assertEqual(getattr(self.store, k), v)
+        self.assertEqual({k: getattr(self.store, k) for k in expected}, expected)
 
     def test_create_from_line(self):
         """Verify that from_line works"""
@@ -65,8 +84,8 @@ class StoreTest(TestCase):
             'city': 'City',
             'state': 'STATE',
             'zip': '12345-1234',
-            'lat': Decimal('33.1234'),
-            'long': Decimal('-96.1234'),
+            'lat': 33.1234,
+            'long': -96.1234,
             'county': 'County',
         }
         line = [
@@ -81,11 +100,17 @@ class StoreTest(TestCase):
             'County',
         ]
         store = Store.from_line(line)
-        for (k, v) in expected.items():
-            self.assertEqual(getattr(store, k), v)
+        self.assertEqual({k: getattr(store, k) for k in expected}, expected)
+
+    def test_create_from_line_extra_columns(self):
+        """Verify that from_line ignores columns past the ones we know about"""
+        line = ['Name', 'Location', 'Address', 'City', 'STATE', '12345', '33.1234', '-96.1234', 'County', 'extra']
+        store = Store.from_line(line)
+        self.assertEqual((store.name, store.county, store.lat), ('Name', 'County', 33.1234))
 
     def test_to_js(self):
         js = self.store.to_js()
+        self.assertEqual(list(js), sorted(js))
         self.assertEqual(js, {
             'name': 'Name',
             'location': 'Human readable location',
@@ -101,6 +126,23 @@ class StoreTest(TestCase):
     def test_get_radian_coords(self):
         coords = self.store.get_radian_coords()
         self.assertEqual(coords, (self.store.lat_radians, self.store.long_radians))
+        self.assertIs(self.store.get_radian_coords(), coords)
+
+    def test_get_rendered_coords(self):
+        """Verify that we format lat/long for display"""
+        self.assertEqual(self.store.get_rendered_coords(), ('33.123', '-96.123'))
+
+    def test_rendered_coords_after_change(self):
+        """Verify that we render a Store's current coordinates"""
+        store = Store(name='A', lat=1, long=2)
+        store.get_rendered_coords()
+        store.lat = 3.0
+        self.assertEqual(store.get_rendered_coords(), ('3.000', '2.000'))
+
+    def test_rendered_coords_half_way(self):
+        """Verify that coordinates ending in 5 round up, as the CSV's decimal text would"""
+        store = Store(name='Germantown', lat='35.0868', long='-89.7555')  # -89.7555 is -89.75549999... as a float
+        self.assertEqual(store.get_rendered_coords(), ('35.087', '-89.756'))
 
     def test_repr(self):
         self.assertEqual(repr(self.store), '<Store Name 33.1234 -96.1234>')
@@ -119,6 +161,13 @@ class StoreTest(TestCase):
         )
         self.assertEqual(s, expected)
 
+    def test_str_after_change(self):
+        """Verify that we render a Store's current fields, not the ones it was first rendered with"""
+        store = Store(name='A', lat=1, long=2)
+        str(store)
+        store.name = 'B'
+        self.assertTrue(str(store).startswith('Store: B\n'))
+
 
 class GreatCircleDistanceTest(TestCase):
 
@@ -180,28 +229,53 @@ class GreatCircleDistanceTest(TestCase):
         for route in routes:
             a = (route['a']['lat'], route['a']['long'])
             b = (route['b']['lat'], route['b']['long'])
-            km_delta = Decimal(margin * route['km'])
-            mi_delta = Decimal(margin * route['mi'])
-            self.assertAlmostEqual(Decimal(route['km']), great_circle_distance(a, b, km=True), delta=km_delta)
-            self.assertAlmostEqual(Decimal(route['mi']), great_circle_distance(a, b, km=False), delta=mi_delta)
+            km_delta = margin * route['km']
+            mi_delta = margin * route['mi']
+            self.assertAlmostEqual(route['km'], great_circle_distance(a, b, km=True), delta=km_delta)
+            self.assertAlmostEqual(route['mi'], great_circle_distance(a, b, km=False), delta=mi_delta)
+
+    def test_radius(self):
+        """Verify that an explicit radius matches the km flag, and overrides it"""
+        a = (0.6596, -2.1366)
+        b = (0.5781, -1.6776)
+        self.assertEqual(great_circle_distance(a, b, radius=EARTH_RADIUS_KM), great_circle_distance(a, b, km=True))
+        self.assertEqual(
+            great_circle_distance(a, b, km=True, radius=EARTH_RADIUS_MI),
+            great_circle_distance(a, b, km=False),
+        )
+
+    def test_cos_lat_b(self):
+        """Verify that passing a pre-computed cos(lat_b) gives the same distance"""
+        a = (0.6596, -2.1366)
+        store = Store(name='B', lat=1.111, long=10.111)
+        b = store.get_radian_coords()
+        self.assertEqual(
+            great_circle_distance(a, b, cos_lat_b=store.cos_lat),
+            great_circle_distance(a, b),
+        )
 
 
 class FileReadingTest(TestCase):
 
+    def setUp(self):
+        get_api_keys.cache_clear()
+        get_store_locations.cache_clear()
+
+    def tearDown(self):
+        get_api_keys.cache_clear()
+        get_store_locations.cache_clear()
+
     def test_get_api_keys(self):
         mocked_open = mock_open(read_data='{"GOOGLE_GEOCODING_API_KEY": "<your key>"}')
         with patch('find_store.open', mocked_open) as m:
             keys = get_api_keys()
             m.assert_called_once_with('api-keys.json')
             self.assertEqual(keys, {'GOOGLE_GEOCODING_API_KEY': '<your key>'})
+            self.assertIs(get_api_keys(), keys)
+            m.assert_called_once_with('api-keys.json')
 
     def test_get_store_locations(self):
-        lines = [
-            'Store Name,Store Location,Address,City,State,Zip Code,Latitude,Longitude,County\n',
-            'Name1,Store Location1,Address1,City1,State1,Zip Code1,1.111,10.111,County1\n',
-            'Name2,Store Location2,Address2,City2,State2,Zip Code2,2.222,20.222,County2\n',
-        ]
-        mocked_open = mock_open(read_data=''.join(lines))
+        mocked_open = mock_open(read_data=STORE_CSV)
         with patch('find_store.open', mocked_open) as _open:
             stores = get_store_locations()
             _open.assert_called_once_with('store-locations.csv')
@@ -209,6 +283,52 @@ class FileReadingTest(TestCase):
                 [repr(s) for s in stores],
                 ['<Store Name1 1.111 10.111>', '<Store Name2 2.222 20.222>']
             )
+            self.assertIsInstance(stores, StoreLocations)
+
+    def test_get_store_locations_cached(self):
+        """Verify that we only read the CSV once"""
+        mocked_open = mock_open(read_data=STORE_CSV)
+        with patch('find_store.open', mocked_open) as _open:
+            stores = get_store_locations()
+            self.assertIs(get_store_locations(), stores)
+            _open.assert_called_once_with('store-locations.csv')
+
+
+class StoreLocationsTest(TestCase):
+
+    def setUp(self):
+        self.stores = [
+            Store(name='A', lat=3.333, long=30.333),
+            Store(name='B', lat=1.111, long=10.111),
+        ]
+
+    def test_sequence(self):
+        """Verify that StoreLocations behaves like the list of stores it was built from"""
+        locations = StoreLocations(self.stores)
+        self.assertEqual(len(locations), 2)
+        self.assertEqual(list(locations), self.stores)
+        self.assertEqual(locations[1], self.stores[1])
+        self.assertEqual(repr(locations), '<StoreLocations (2 stores)>')
+
+    def test_coordinate_arrays(self):
+        """Verify that we pack the radian coordinates into arrays in store order"""
+        locations = StoreLocations(self.stores)
+        self.assertEqual(list(locations.lat_radians), [s.lat_radians for s in self.stores])
+        self.assertEqual(list(locations.long_radians), [s.long_radians for s in self.stores])
+
+    def test_tree(self):
+        """Verify that the KD-tree holds each store as a point on the unit sphere"""
+        locations = StoreLocations(self.stores)
+        self.assertEqual(len(locations.tree.data), len(self.stores))
+        for (point, idx) in zip(locations.tree.data, locations.tree_index):
+            self.assertAlmostEqual(sum(point * point), 1.0)
+            self.assertAlmostEqual(asin(point[2]), self.stores[idx].lat_radians)
+
+    def test_tree_duplicates(self):
+        """Verify that stores at the same location share one tree point, mapped to the first of them"""
+        locations = StoreLocations(self.stores + [Store(name='C', lat=3.333, long=30.333)])
+        self.assertEqual(len(locations.tree.data), 2)
+        self.assertEqual(sorted(locations.tree_index), [0, 1])
 
 
 class FindStoreTest(TestCase):
@@ -223,12 +343,88 @@ class FindStoreTest(TestCase):
     def test_find_km(self):
         store, distance = _find_store(start=[0.6596, -2.1366], units='km', stores=self.stores)
         self.assertEqual(store, self.stores[1])
-        self.assertAlmostEqual(distance, Decimal('13523.02'), places=2)
+        self.assertAlmostEqual(distance, 13523.02, places=2)
 
     def test_find_mi(self):
         store, distance = _find_store(start=[0.6596, -2.1366], units='mi', stores=self.stores)
         self.assertEqual(store, self.stores[1])
-        self.assertAlmostEqual(distance, Decimal('8402.81'), places=2)
+        self.assertAlmostEqual(distance, 8402.81, places=2)
+
+    def test_find_matches_brute_force(self):
+        """Verify that the KD-tree finds the same store (at the same distance) as checking every store"""
+        starts = [(0.6596, -2.1366), (0.0, 0.0), (-0.7, 2.5), (0.04, 0.35)]
+        for start in starts:
+            expected = min(self.stores, key=lambda s: great_circle_distance(start, s.get_radian_coords()))
+            store, distance = _find_store(start=start, units='km', stores=self.stores)
+            self.assertEqual(store, expected)
+            self.assertAlmostEqual(distance, great_circle_distance(start, expected.get_radian_coords()), places=6)
+
+    def test_find_first_of_ties(self):
+        """Verify that we return the first of several equally-close stores (more than fit in one tree leaf)"""
+        stores = [Store(name=str(i), lat=i % 7, long=i % 5) for i in range(200)]
+        start = (radians(2.1), radians(3.1))
+        store, distance = _find_store(start=start, units='mi', stores=stores)
+        tied = [s for s in stores if (s.lat, s.long) == (2, 3)]
+        self.assertEqual([s.name for s in tied], ['23', '58', '93', '128', '163', '198'])
+        self.assertIs(store, tied[0])
+        self.assertAlmostEqual(distance, great_circle_distance(start, store.get_radian_coords(), km=False), places=6)
+
+    def test_find_first_of_ties_different_locations(self):
+        """Verify that we return the first of equally-close stores at different locations"""
+        stores = [Store(name='A', lat=0, long=10), Store(name='B', lat=0, long=-10)]
+        store, _ = _find_store(start=(0.0, 0.0), units='mi', stores=stores)
+        self.assertIs(store, stores[0])
+
+        # four stores placed symmetrically around the start, in every order
+        around = [(0, 10), (0, -10), (10, 0), (-10, 0)]
+        for order in permutations(around):
+            stores = [Store(name=str(i), lat=lat, long=long) for (i, (lat, long)) in enumerate(order)]
+            store, _ = _find_store(start=(0.0, 0.0), units='mi', stores=stores)
+            self.assertIs(store, stores[0])
+
+    def test_find_store_locations(self):
+        """Verify that we get the same answer when given a pre-built StoreLocations"""
+        store, distance = _find_store(start=[0.6596, -2.1366], units='mi', stores=StoreLocations(self.stores))
+        self.assertEqual(store, self.stores[1])
+        self.assertAlmostEqual(distance, 8402.81, places=2)
+
+
+class FindStoreCachedTest(TestCase):
+
+    def setUp(self):
+        _find_store_by_ref.cache_clear()
+        self.stores = StoreLocations([
+            Store(name='A', lat=3.333, long=30.333),
+            Store(name='B', lat=1.111, long=10.111),
+        ])
+
+    def tearDown(self):
+        _find_store_by_ref.cache_clear()
+
+    def test_cached(self):
+        """Verify that we only search once for a repeated query"""
+        with patch('find_store.find_store', wraps=_find_store) as _find:
+            first = _find_store_cached((0.6596, -2.1366), self.stores, 'mi')
+            second = _find_store_cached((0.6596, -2.1366), self.stores, 'mi')
+            _find.assert_called_once_with((0.6596, -2.1366), self.stores, 'mi')
+        self.assertIs(first, second)
+        self.assertEqual(first[0], self.stores[1])
+
+    def test_not_cached_across_stores(self):
+        """Verify that reloaded stores get searched again"""
+        reloaded = StoreLocations(list(self.stores))
+        with patch('find_store.find_store', wraps=_find_store) as _find:
+            _find_store_cached((0.6596, -2.1366), self.stores, 'mi')
+            _find_store_cached((0.6596, -2.1366), reloaded, 'mi')
+            self.assertEqual(_find.call_count, 2)
+
+    def test_stores_not_kept_alive(self):
+        """Verify that cached results don't keep an old StoreLocations in memory"""
+        stores_ref = weakref.ref(self.stores)
+        _find_store_cached((0.6596, -2.1366), self.stores, 'mi')
+        del self.stores
+        gc.collect()
+        self.assertIsNone(stores_ref())
 
 
 class RenderTest(TestCase):
@@ -249,7 +445,7 @@ class RenderTest(TestCase):
     def test_render_json(self):
         rendered = ''
         with patch('sys.stdout', new_callable=StringIO) as out:
-            render(self.store, distance=Decimal(1234.5678), units='furlongs', output='json')
+            render(self.store, distance=1234.5678, units='furlongs', output='json')
             rendered = out.getvalue()
 
         expected = json.dumps({
@@ -260,9 +456,39 @@ class RenderTest(TestCase):
 
         self.assertEqual(rendered, expected + '\n')
 
+    def test_render_json_stdlib(self):
+        """Verify that we render the same JSON when orjson isn't installed"""
+        with patch('sys.stdout', new_callable=StringIO) as out:
+            render(self.store, distance=1234.5678, units='furlongs', output='json')
+            rendered = out.getvalue()
+
+        with patch('find_store.orjson', None):
+            with patch('sys.stdout', new_callable=StringIO) as out:
+                render(self.store, distance=1234.5678, units='furlongs', output='json')
+                self.assertEqual(out.getvalue(), rendered)
+
+    def test_render_json_non_ascii(self):
+        """Verify that non-ASCII characters are escaped, with or without orjson"""
+        self.store.county = 'Do\u00c3\u00b1a Ana County'  # as in store-locations.csv
+        expected = json.dumps({
+            'store': self.store.to_js(),
+            'distance': '1234.568',
+            'units': 'furlongs',
+        }, indent=2, sort_keys=True) + '\n'
+        self.assertIn('"county": "Do\\u00c3\\u00b1a Ana County"', expected)
+
+        with patch('sys.stdout', new_callable=StringIO) as out:
+            render(self.store, distance=1234.5678, units='furlongs', output='json')
+            self.assertEqual(out.getvalue(), expected)
+
+        with patch('find_store.orjson', None):
+            with patch('sys.stdout', new_callable=StringIO) as out:
+                render(self.store, distance=1234.5678, units='furlongs', output='json')
+                self.assertEqual(out.getvalue(), expected)
+
     def test_render_text(self):
         with patch('sys.stdout', new_callable=StringIO) as out:
-            render(self.store, distance=Decimal(1234.5678), units='furlongs', output='text')
+            render(self.store, distance=1234.5678, units='furlongs', output='text')
             rendered = out.getvalue()
 
         self.assertEqual(rendered, (
@@ -278,6 +504,35 @@ class RenderTest(TestCase):
         ))
 
 
+class ClientTest(TestCase):
+
+    def setUp(self):
+        _client.cache_clear()
+        _geocode.cache_clear()
+
+    def tearDown(self):
+        _client.cache_clear()
+        _geocode.cache_clear()
+
+    def test_client_shared(self):
+        """Verify that we only make one googlemaps.Client, with our API key"""
+        with patch('find_store.get_api_keys', return_value={'GOOGLE_GEOCODING_API_KEY': '<your key>'}):
+            with patch('googlemaps.Client') as client:
+                self.assertIs(_client(), _client())
+                client.assert_called_once_with(key='<your key>')
+
+    def test_geocode_cached(self):
+        """Verify that we only ask the geocoding API once per query"""
+        with patch('find_store._client') as client:
+            client.return_value.geocode.return_value = [{'geometry': {}}]
+            self.assertIs(_geocode('94115'), _geocode('94115'))
+            _geocode('10005')
+            self.assertEqual(
+                [c[0] for c in client.return_value.geocode.call_args_list],
+                [('94115',), ('10005',)],
+            )
+
+
 class MainTest(TestCase):
 
     def setUp(self):
@@ -291,6 +546,11 @@ class MainTest(TestCase):
         ]
         self.stores = [Store.from_line(line.split(',')) for line in csv_lines]
 
+    def tearDown(self):
+        _client.cache_clear()
+        _geocode.cache_clear()
+        _find_store_by_ref.cache_clear()
+
     def test_main(self):
         cases = [
             {
@@ -380,6 +640,8 @@ class MainTest(TestCase):
                 '--output': output,
             }
 
+            _client.cache_clear()
+            _geocode.cache_clear()
             with patch('googlemaps.Client', return_value=fake_client):
                 with patch('sys.stdout', new_callable=StringIO) as out:
                     with patch('find_store.docopt', return_value=opts) as docopt: